@@ -1,8 +1,11 @@
 import sys
 import os
+import re
 import time
 import logging
-from pybit.unified_trading import HTTP
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pybit.unified_trading import HTTP, WebSocket
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -20,6 +23,11 @@ API_KEY = os.getenv("BYBIT_API_KEY")
 API_SECRET = os.getenv("BYBIT_API_SECRET")
 SYMBOL = "WLDUSDT"
 TESTNET = os.getenv("BYBIT_TESTNET", "false").lower() == "true"
+SYMBOL_BYTES = SYMBOL.encode()
+
+# Formato esperado del C++ corregido: SIGNAL|SYMBOL|SIDE|PRICE|TYPE
+# Ej: SIGNAL|WLDUSDT|BUY|0.3915|MARKET
+SIGNAL_RE = re.compile(rb"^SIGNAL\|([^|]+)\|(BUY|SELL)\|([0-9.]+)")
 
 # PARAMETROS DE LA ESTRATEGIA "TITAN SMART TRAP HUNTER"
 LEVERAGE = 50
@@ -27,15 +35,32 @@ RISK_FACTOR = 0.90      # Usar el 90% del saldo disponible
 TP_TICKS = 0.0009       # Target: 9 Ticks (Fijo)
 SL_TICKS = 0.0006       # Stop: 6 Ticks (Fijo)
 COOLDOWN_SECONDS = 900  # 15 Minutos de descanso obligatorio
+STOPS_FIRST_POLL = 0.1  # Primer intento de leer la entrada real (backoff x2)
+STOPS_MAX_POLLS = 6     # 0.1 + 0.2 + ... + 3.2 = ~6.3s como máximo
+KEEPALIVE_SECONDS = 20  # Ping REST para mantener caliente la conexión TLS
+CLOSE_CHECK_SECONDS = 30  # Verificación REST de respaldo si el WS privado calla
 
 # --- BYBIT SESSION ---
 try:
+    # pybit ya reutiliza un único requests.Session (session.client) con keep-alive;
+    # lo único que hace falta es que la conexión no muera en esperas largas (keep_alive)
     session = HTTP(testnet=TESTNET, api_key=API_KEY, api_secret=API_SECRET)
     logger.info("CONEXIÓN CON BYBIT ESTABLECIDA.")
 except Exception as e:
     logger.error(f"ERROR DE CONEXIÓN: {e}")
     sys.exit(1)
 
+def keep_alive():
+    """Mantiene viva la conexión HTTP durante esperas largas (cooldown) con /v5/market/time"""
+    while True:
+        time.sleep(KEEPALIVE_SECONDS)
+        try:
+            session.get_server_time()
+        except Exception as e:
+            logger.warning(f"KEEP-ALIVE FALLIDO: {e}")
+
+threading.Thread(target=keep_alive, daemon=True).start()
+
 # Configurar Apalancamiento al iniciar
 def set_leverage():
     try:
@@ -47,8 +72,78 @@ def set_leverage():
 
 set_leverage()
 
+# --- PRIVATE WS (POSICIÓN Y SALDO EN TIEMPO REAL) ---
+# Bybit empuja cada cambio de la posición; el cierre se detecta en ms sin polling REST.
+position_closed = threading.Event()
+# Tamaño neto de nuestras ejecuciones desde la entrada (Buy +, Sell -). Vuelve a 0
+# en el fill que cierra, normalmente antes de que llegue el push de `position`.
+net_size = 0.0
+# Bybit también empuja `position` al crear/modificar órdenes sin cambio de tamaño:
+# un size 0 solo cuenta como cierre si antes se vio la posición abierta.
+position_seen_open = False
+position_lock = threading.Lock()
+# Último saldo USDT empujado por el stream `wallet` (None hasta el primer dato)
+latest_balance = None
+balance_lock = threading.Lock()
+
+def handle_position(message):
+    global position_seen_open
+    for pos in message.get("data", []):
+        if pos.get("symbol") != SYMBOL:
+            continue
+        size = float(pos.get("size") or 0)
+        with position_lock:
+            if size > 0:
+                position_seen_open = True
+            elif position_seen_open:
+                position_closed.set()
+
+def handle_execution(message):
+    global net_size
+    for ex in message.get("data", []):
+        # Solo fills reales (no Funding, ADL, etc.)
+        if ex.get("symbol") != SYMBOL or ex.get("execType") != "Trade":
+            continue
+        qty = float(ex['execQty'])
+        with position_lock:
+            net_size += qty if ex['side'] == "Buy" else -qty
+            if abs(net_size) < 1e-9:
+                position_closed.set()
+
+def arm_close_detection():
+    """Reinicia el contador neto y el evento de cierre justo antes de una entrada"""
+    global net_size, position_seen_open
+    with position_lock:
+        net_size = 0.0
+        position_seen_open = False
+        position_closed.clear()
+
+def handle_wallet(message):
+    global latest_balance
+    for account in message.get("data", []):
+        if account.get("accountType") != "UNIFIED":
+            continue
+        for coin in account.get("coin", []):
+            if coin.get("coin") == "USDT":
+                with balance_lock:
+                    latest_balance = float(coin['walletBalance'])
+
+try:
+    private_ws = WebSocket(testnet=TESTNET, channel_type="private", api_key=API_KEY, api_secret=API_SECRET)
+    private_ws.position_stream(callback=handle_position)
+    private_ws.execution_stream(callback=handle_execution)
+    private_ws.wallet_stream(callback=handle_wallet)
+    logger.info("STREAMS PRIVADOS DE POSICIÓN, EJECUCIONES Y SALDO SUSCRITOS.")
+except Exception as e:
+    logger.error(f"ERROR EN WS PRIVADO: {e}")
+    sys.exit(1)
+
 def get_wallet_balance():
     """Obtiene el saldo USDT disponible en la cuenta de Derivados Unificada"""
+    # El stream `wallet` empuja cada cambio de saldo; REST solo si aún no llegó ningún dato
+    with balance_lock:
+        if latest_balance is not None:
+            return latest_balance
     try:
         response = session.get_wallet_balance(accountType="UNIFIED", coin="USDT")
         # Navegar la respuesta de Bybit (puede variar según tipo de cuenta, ajustar si es necesario)
@@ -71,6 +166,47 @@ def has_open_position():
         logger.error(f"ERROR VERIFICANDO POSICIONES: {e}")
         return True # Ante duda, bloqueamos (Fail-Safe)
 
+stops_pool = ThreadPoolExecutor(max_workers=2)
+
+def update_stops(side):
+    """Recalcula TP/SL desde el precio de entrada real (garantiza ticks reales desde Entry Price)"""
+    delay = STOPS_FIRST_POLL
+    try:
+        for _ in range(STOPS_MAX_POLLS):
+            time.sleep(delay) # Backoff exponencial hasta ver el fill en la API
+            delay *= 2
+            pos_data = session.get_positions(category="linear", symbol=SYMBOL)['result']['list']
+            for pos in pos_data:
+                size = float(pos['size'])
+                if size > 0:
+                    avg_entry = float(pos['avgPrice'])
+                    
+                    # Recalcular TP/SL exactos desde la entrada real
+                    if side == "Buy":
+                        real_tp = avg_entry + TP_TICKS
+                        real_sl = avg_entry - SL_TICKS
+                    else: # Sell
+                        real_tp = avg_entry - TP_TICKS
+                        real_sl = avg_entry + SL_TICKS
+                        
+                    real_tp = round(real_tp, 4)
+                    real_sl = round(real_sl, 4)
+                    
+                    session.set_trading_stop(
+                        category="linear",
+                        symbol=SYMBOL,
+                        takeProfit=str(real_tp),
+                        stopLoss=str(real_sl),
+                        tpTriggerBy="LastPrice",
+                        slTriggerBy="LastPrice",
+                        positionIdx=0 # Modo One-Way
+                    )
+                    logger.info(f"TP/SL ACTUALIZADO A ENTRADA REAL ({avg_entry}): TP {real_tp} | SL {real_sl}")
+                    return
+        logger.warning("TP/SL NO ACTUALIZADO: POSICIÓN NO VISIBLE EN LA API.")
+    except Exception as update_err:
+        logger.error(f"FALLO ACTUALIZANDO TP/SL: {update_err}")
+
 def execute_order(side, price):
     # 0. POSITION GUARD (Evitar doble entrada)
     if has_open_position():
@@ -111,6 +247,7 @@ def execute_order(side, price):
 
     # 4. ENVIAR ORDEN (Inicial con TP/SL estimados)
     try:
+        arm_close_detection()
         session.place_order(
             category="linear",
             symbol=SYMBOL,
@@ -125,45 +262,16 @@ def execute_order(side, price):
         sys.stderr.write(f"[EXECUTED] {side} {qty} WLD @ {price} (Bal: {balance:.2f})\n")
         sys.stderr.flush()
         
-        # 5. AJUSTE DINÁMICO DE TP/SL (Para garantizar ticks reales desde Entry Price)
-        time.sleep(1) # Esperar 1s para asegurar fill y actualización de API
-        
-        try:
-            pos_data = session.get_positions(category="linear", symbol=SYMBOL)['result']['list']
-            for pos in pos_data:
-                size = float(pos['size'])
-                if size > 0:
-                    avg_entry = float(pos['avgPrice'])
-                    
-                    # Recalcular TP/SL exactos desde la entrada real
-                    if side == "Buy":
-                        real_tp = avg_entry + TP_TICKS
-                        real_sl = avg_entry - SL_TICKS
-                    else: # Sell
-                        real_tp = avg_entry - TP_TICKS
-                        real_sl = avg_entry + SL_TICKS
-                        
-                    real_tp = round(real_tp, 4)
-                    real_sl = round(real_sl, 4)
-                    
-                    session.set_trading_stop(
-                        category="linear",
-                        symbol=SYMBOL,
-                        takeProfit=str(real_tp),
-                        stopLoss=str(real_sl),
-                        tpTriggerBy="LastPrice",
-                        slTriggerBy="LastPrice",
-                        positionIdx=0 # Modo One-Way
-                    )
-                    logger.info(f"TP/SL ACTUALIZADO A ENTRADA REAL ({avg_entry}): TP {real_tp} | SL {real_sl}")
-                    break
-        except Exception as update_err:
-             logger.error(f"FALLO ACTUALIZANDO TP/SL: {update_err}")
+        # 5. AJUSTE DINÁMICO DE TP/SL (En paralelo: no retrasa la espera del cierre)
+        stops_pool.submit(update_stops, side)
 
         # 6. ESPERAR CIERRE DE POSICIÓN
         logger.info("ESPERANDO CIERRE DE POSICIÓN PARA INICIAR COOLDOWN...")
-        while has_open_position():
-            time.sleep(1)
+        # Ejecuciones y posición (WS) marcan el cierre; la consulta REST cada CLOSE_CHECK_SECONDS
+        # solo cubre una reconexión del stream privado que se coma el push de cierre
+        while not position_closed.wait(CLOSE_CHECK_SECONDS):
+            if not has_open_position():
+                break
             
         # 7. COOLDOWN OBLIGATORIO POST-CIERRE
         logger.info(f"POSICIÓN CERRADA. ENTRANDO EN COOLDOWN DE {COOLDOWN_SECONDS} SEGUNDOS...")
@@ -178,29 +286,22 @@ def main():
     
     while True:
         try:
-            # Leer línea del C++
-            line = sys.stdin.readline()
+            # Leer línea del C++ (bytes crudos, sin decodificar)
+            line = sys.stdin.buffer.readline()
             if not line: break
-            line = line.strip()
             
-            # FILTRO DE SEÑAL
-            # Formato esperado del C++ corregido: SIGNAL|SYMBOL|SIDE|PRICE|TYPE
-            if line.startswith("SIGNAL"):
-                parts = line.split("|")
-                # parts[0]=SIGNAL, [1]=WLDUSDT, [2]=BUY, [3]=0.3915, [4]=MARKET
-                
-                if len(parts) < 4: continue
-                
-                cmd_sym = parts[1]
-                side = parts[2] # "BUY"
-                price = float(parts[3])
-                
-                if cmd_sym != SYMBOL: continue
-                
-                # Bybit espera "Buy" o "Sell" (Capitalized)
-                side_formatted = side.capitalize() 
-                
-                execute_order(side_formatted, price)
+            # FILTRO DE SEÑAL: un solo match extrae SYMBOL, SIDE y PRICE
+            m = SIGNAL_RE.match(line)
+            if not m: continue
+            
+            cmd_sym, side, price = m.group(1), m.group(2), float(m.group(3))
+            
+            if cmd_sym != SYMBOL_BYTES: continue
+            
+            # Bybit espera "Buy" o "Sell" (Capitalized)
+            side_formatted = side.decode().capitalize()
+            
+            execute_order(side_formatted, price)
                 
         except KeyboardInterrupt:
             logger.info("APAGANDO NERVE...")